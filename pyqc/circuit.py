@@ -6,45 +6,104 @@ Created on Fri Oct 15 11:22:14 2021
 @author: ronan
 """
 #%% Imports
+from typing import Callable
 from .gates import *
 
 
 class PQC():
     """A class to define an n qubit wide, p layer deep Parameterised Quantum
-    Circuit."""
+    Circuit. Internally states are plain numpy arrays of the given dtype and
+    only wrapped as qutip objects when returned - complex64 halves the memory
+    traffic of running the circuit but is only accurate to ~1e-7. With
+    backend="cupy" (experimental, cupy is optional) the state arrays and gate
+    kernels live on the GPU."""
+    dtype: type = np.complex128
+    xp = np #array module the state arrays belong to
 
-    def __init__(self, n_qubits: QubitNumber) -> None:
+    def __init__(self, n_qubits: QubitNumber, dtype: type=np.complex128, backend: Literal["numpy", "cupy"]="numpy") -> None:
         self.n_qubits: QubitNumber = n_qubits
+        self.dtype = dtype
+        if backend == "cupy":
+            import cupy
+            self.xp = cupy
+        elif backend != "numpy":
+            raise Exception(f"Unknown backend {backend}!")
         self.n_layers: int = 0
         self.layers: list[Layer] = []
         if n_qubits >= 2:
             self.set_H('ZZ')
-        self.initial_state: qt.Qobj = qt.tensor([qt.basis(2, 0) for i in range(self.n_qubits)])
+        initial_state_arr: np.ndarray = self.xp.zeros(2**n_qubits, dtype=self.dtype)
+        initial_state_arr[0] = 1 #|00...0>
+        self.initial_state_arr: np.ndarray = initial_state_arr
         self.state: qt.Qobj = self.initial_state
 
     def set_H(self, H: Union[str, qt.Qobj]):
         """Set Hamiltonian PQC uses for training and gradient calculation. Default is 'ZZ'
-        Hamiltonian but custom qutip hamiltonians can be set."""
+        Hamiltonian but custom qutip hamiltonians can be set. If H is diagonal (like
+        any string of Z's) only its diagonal is used, so H|psi> is an O(2^N)
+        elementwise product."""
+        real_dtype: type = np.finfo(self.dtype).dtype
         if H == 'ZZ':
             Z0: qt.Qobj = genFockOp(qt.sigmaz(), 0, self.n_qubits, 2)
             Z1: qt.Qobj = genFockOp(qt.sigmaz(), 1, self.n_qubits, 2)
             self.H = Z0 * Z1
+            self._h_diag: Union[np.ndarray, None] = self.xp.asarray(z_string_diag([0, 1], self.n_qubits).astype(real_dtype))
         else:
             self.H = H
+            entries = H.data.tocoo()
+            if np.all(entries.row == entries.col):
+                self._h_diag = self.xp.asarray(np.real(H.data.diagonal()).astype(real_dtype))
+            else:
+                self._h_diag = None
+                self._H_sparse = H.data
+                if self.xp is not np:
+                    import cupyx.scipy.sparse
+                    self._H_sparse = cupyx.scipy.sparse.csr_matrix(H.data.astype(self.dtype))
+
+    def _apply_H(self, psi: np.ndarray) -> np.ndarray:
+        """H|psi> of a flat state array, or of a (B, 2^N) batch of them."""
+        if self._h_diag is not None:
+            return self._h_diag * psi
+        flat: np.ndarray = psi.reshape(-1, psi.shape[-1])
+        return (self._H_sparse @ flat.T).T.reshape(psi.shape).astype(self.dtype)
+
+    @property
+    def initial_state_arr(self) -> np.ndarray:
+        """Flat array of the initial state the circuit is run from."""
+        return self._initial_state_arr
+
+    @initial_state_arr.setter
+    def initial_state_arr(self, state: np.ndarray) -> None:
+        self._initial_state_arr: np.ndarray = state
+        self._initial_state: Union[qt.Qobj, None] = None
+
+    @property
+    def initial_state(self) -> qt.Qobj:
+        """Initial state as a qutip object, only made when asked for."""
+        if self._initial_state is None:
+            self._initial_state = self._to_qobj(self.initial_state_arr)
+        return self._initial_state
+
+    @initial_state.setter
+    def initial_state(self, state: qt.Qobj) -> None:
+        self.initial_state_arr = self.xp.asarray(state.full().ravel().astype(self.dtype))
+        self._initial_state = state
 
     def set_initial_state(self, state: qt.Qobj) -> None:
-        self.initial_state = qt.tensor([state for i in range(self.n_qubits)])
+        """Start from the product state |state>|state>...|state>."""
+        single: np.ndarray = state.full().ravel()
+        self.initial_state_arr = self.xp.asarray(reduce(np.kron, [single] * self.n_qubits).astype(self.dtype))
 
     def add_layer(self, layer: Layer, n: int=1) -> None:
         """Add $n layers to PQC.layers"""
         for i in range(n):
-            self.layers.append(deepcopy(layer))
+            self.layers.append([g.clone() for g in layer])
         self.n_layers += n
         self.set_gates() #update PQC.gates when adding
 
     def set_layer(self, layer: Layer, pos: int) -> None:
         """Set nth layer of PQC to given layer. Will throw error if pos not available"""
-        self.layers[pos] = deepcopy(layer)
+        self.layers[pos] = [g.clone() for g in layer]
         self.set_gates()
 
     def get_layer(self, pos: int) -> Layer:
@@ -54,11 +113,21 @@ class PQC():
         """For each layer in layer, append it to gates. If layers is a nested list
         of layers, then gates is a flat list of each gate operation in order. Then
         iterate through gates and update a list that says if a gate is parameterised
-        or not (-1), and which parameterised gate it is, i.e is it the 1st, 2nd, ..."""
+        or not (-1), and which parameterised gate it is, i.e is it the 1st, 2nd, ...
+        Unparameterised blocks like CHAIN are expanded into the gates they're made of.
+        Blocks sharing a parameter stay as one gate in gates, but are run as the
+        gates they're made of - PQC._ops has the gates each of gates is applied as."""
         layers: Layer = []
         for i in self.layers:
-            layers = layers + i
+            for gate in i:
+                layers = layers + (gate.as_layer() if not gate.is_param else [gate])
         self.gates: Layer = layers
+        self._ops: list[Layer] = [g.as_layer() for g in self.gates]
+        for op in flatten(self._ops): #wires are fixed so only need to work out how to unfold the state once
+            op._perms = axis_permutations(tuple(op._wires), self.n_qubits)
+            if op._xp is not self.xp:
+                op._xp = self.xp
+                op._kernel = op._kernel #move the current kernel over
         self.parameterised: list[int] = []
         total_param_count: int = 0
         for gate in self.gates:
@@ -85,45 +154,83 @@ class PQC():
 
     def set_params(self, angles: Union[list[Angle], Literal["random"]]) -> None:
         """Set the parameters of every parameterised gate (i.e inherits from PRot)
-        in the circuit. Can set either randomly or from a specified list"""
+        in the circuit. Can set either randomly or from a specified list. Random
+        angles are drawn all at once and the gates only rebuild their kernels
+        when the circuit is next run."""
         parameterised: list[Gate] = [g for g in self.gates if g.is_param]
+        # start by checking if it's random so otherwise type check knows it will be type list[Angle]
+        if type(angles) == str:
+            if angles != "random":
+                raise Exception("No parameters supplied!")
+            angles = rng.uniform(0, 2 * np.pi, size=sum(g.param_count for g in parameterised))
         param_counter: int = 0
         for g in parameterised:
+            g.set_theta(angles[param_counter])
             if g.param_count == 2:
-                angle1: Angle
-                angle2: Angle
-                # start by checking if it's random so otherwise type check knows it will be type list[Angle]
-                if type(angles) != str:
-                    angle1 = angles[param_counter]
-                    angle2 = angles[param_counter + 1]
-                elif angles == "random": #use random params
-                    angle1 = rng.random(1)[0] * 2 * np.pi
-                    angle2 = rng.random(1)[0] * 2 * np.pi
-                else:
-                    raise Exception("No parameters supplied!")
-                g.set_theta(angle1)
-                g.set_phi(angle2)
-                param_counter += 2
-
-            elif g.param_count == 1:
-                if type(angles) != str:
-                    angle1 = angles[param_counter]
-                elif angles == "random": #use random params
-                    angle1 = rng.random(1)[0] * 2 * np.pi
-                else:
-                    raise Exception("No parameters supplied!")
-                g.set_theta(angle1)
-                param_counter += 1
+                g.set_phi(angles[param_counter + 1])
+            param_counter += g.param_count
     
+    def _forward(self) -> np.ndarray:
+        """Act each gate's kernel on the initial state with the current parameters.
+        The state is kept as a (2,)*N tensor so gates never need expanding to the
+        full 2^N x 2^N operator.
+        Returns:
+            psi: flat array of the circuit state.
+        """
+        psi: np.ndarray = self.initial_state_arr.reshape((2,) * self.n_qubits)
+        for ops in self._ops:
+            for g in ops:
+                psi = apply_kernel(g._kernel, psi, g._wires, xp=self.xp, diagonal=g._is_diagonal, perms=g._perms)
+        return psi.reshape(-1)
+
+    def _to_numpy(self, arr: np.ndarray) -> np.ndarray:
+        """Copy an array back from the GPU if using the cupy backend."""
+        return arr if self.xp is np else self.xp.asnumpy(arr)
+
+    def _to_qobj(self, psi: np.ndarray) -> qt.Qobj:
+        return qt.Qobj(self._to_numpy(psi).reshape(-1, 1), dims=[[2] * self.n_qubits, [1] * self.n_qubits])
+
+    def _energy(self, psi: np.ndarray) -> float:
+        """<psi|H|psi> of a flat state array."""
+        return float(self.xp.real(self.xp.vdot(psi, self._apply_H(psi))))
+
     def run(self, angles: Union[list[Angle], Literal["random"]]) -> qt.Qobj:
-        """Get |psi> of a PQC by multiplying the basis state by the gates when gates
+        """Get |psi> of a PQC by acting the gates on the basis state when gates
         parameterised by angles."""
-        circuit_state = self.initial_state
         self.set_params(angles=angles)
-        for g in self.gates:
-            circuit_state = g * circuit_state
+        circuit_state: qt.Qobj = self._to_qobj(self._forward())
         return circuit_state
 
+    def run_batch(self, angles: np.ndarray) -> np.ndarray:
+        """Run the circuit for a batch of parameter sets at once, i.e the
+        evaluations an optimiser like SPSA or a finite difference gradient needs
+        each step. The states carry a leading batch axis and each gate's kernels
+        are built for every parameter set in one go, so the python overhead of
+        running the circuit is paid once for all B sets. The gates' own
+        parameters aren't changed.
+        Args:
+            angles: (B, n_params) array, a row of parameters per circuit
+        Returns:
+            psi: (B, 2^N) array of the circuit states
+        """
+        angles = self.xp.asarray(angles)
+        B: int = angles.shape[0]
+        psi: np.ndarray = self.xp.broadcast_to(self.initial_state_arr.reshape((2,) * self.n_qubits), (B,) + (2,) * self.n_qubits)
+        param_counter: int = 0
+        for g in self.gates:
+            param_count: int = g.param_count if g.is_param else 0
+            params: list[np.ndarray] = [angles[:, param_counter + i] for i in range(param_count)]
+            for kernel, wires in g.kernel_ops(params, xp=self.xp):
+                psi = apply_kernel_batch(kernel, psi, wires, xp=self.xp, diagonal=g._is_diagonal)
+            param_counter += param_count
+        return psi.reshape(B, -1)
+
+    def cost_batch(self, angles: np.ndarray) -> np.ndarray:
+        """<psi|H|psi> for each row of a (B, n_params) array of parameters (see run_batch)."""
+        psi: np.ndarray = self.run_batch(angles)
+        h_psi: np.ndarray = self._apply_H(psi)
+        return self._to_numpy(self.xp.real(self.xp.sum(psi.conj() * h_psi, axis=1)))
+
     def update_state(self, angles: Union[list[Angle], Literal["random"]]) -> qt.Qobj:
         """Set quantum state of circuit from angles and return it. Modifies an attribute."""
         self.state = qt.Qobj(self.run(angles))
@@ -131,9 +238,10 @@ class PQC():
 
     def cost(self, angles: Union[list[Angle], Literal["random"]]) -> float:
         """Get energy of |psi>, the initial quantum state via <psi|H|psi>"""
-        self.state = self.run(angles=angles)
-        psi = self.state
-        energy: float = qt.expect(self.H, psi)
+        self.set_params(angles=angles)
+        psi: np.ndarray = self._forward()
+        self.state = self._to_qobj(psi)
+        energy: float = self._energy(psi)
         return energy
 
     def fidelity(self, target_state: qt.Qobj) -> float:
@@ -148,27 +256,26 @@ class PQC():
 
     def take_derivative(self, g_on: Gate, param: Literal[0, 1, 2]=0) -> Gradient:
         """Get the derivative of the ith parameter of the circuit and return
-        the circuit where the ith gate is multiplied by its derivative.
+        the circuit where the ith gate is multiplied by its derivative. For a
+        block sharing a parameter this is the sum (product rule) over its gates
+        of the circuit with that gate's derivative multiplied in after it.
         Returns:
             circuit_state: Gradient of circuit w.r.t ith parameter.
         """
-        #need to find which gate the ith parameterised gate is
-        g_loc: int = self.gates.index(g_on) 
-        #copy so don't overwrite later - much better than deepcopying whole circuit!
-        gate: Gate = copy(self.gates[g_loc])
-        #find the derivative using the gate's derivative method
-        if param == 0:
-            deriv = gate.derivative()
-        else: #find ith deriv for multi parameterised gates
-            deriv = gate.parameterised_derivative(param)
-        #set pth gate to be deriv * gate
-        self.gates[g_loc] = deriv * gate
-        #act the derivative of circuit on |0>
-        circuit_state: qt.Qobj = self.initial_state
-        for g in self.gates:
-            circuit_state = g * circuit_state
-        #reset the gate back to what it was originally
-        self.gates[g_loc] = gate
+        position: int = next(j for j, g in enumerate(self.gates) if g is g_on)
+        ops: Layer = self._ops[position]
+        psi: np.ndarray = self.initial_state_arr.reshape((2,) * self.n_qubits)
+        psi = self._run_ops(psi, flatten(self._ops[:position])) #state before g_on
+        d_psi: np.ndarray = 0
+        for k, op in enumerate(ops):
+            if not op.is_param:
+                continue
+            #find the derivative using the gate's derivative method, or the ith deriv for multi parameterised gates
+            deriv: Derivative = op.derivative() if param == 0 else op.parameterised_derivative(param)
+            psi_k: np.ndarray = self._run_ops(psi, ops[:k + 1])
+            d_psi = d_psi + self._run_ops(sum(self._run_ops(psi_k, [term]) for term in deriv), ops[k + 1:])
+        psi = self._run_ops(d_psi, flatten(self._ops[position + 1:]))
+        circuit_state: qt.Qobj = self._to_qobj(psi)
         return circuit_state
 
     def get_gradients(self) -> list[Gradient]:
@@ -185,12 +292,146 @@ class PQC():
                 gradient_state_list.append(gradient)
             elif g.param_count == 2:
                 gradient1: Gradient = self.take_derivative(g, param=1) 
-                g_prime = self.gates[count] # copy op in take deriv changes ref of ith gate so need to 'find' it again
-                gradient2 = self.take_derivative(g_prime, param=2)
+                gradient2 = self.take_derivative(g, param=2)
                 gradient_state_list.append(gradient1)
                 gradient_state_list.append(gradient2)
         return gradient_state_list
 
+    def get_gradients_adjoint(self) -> list[float]:
+        """Get the gradient of the energy <psi|H|psi> w.r.t each parameter using
+        the adjoint method: run the circuit forward once, then sweep back through
+        the gates undoing each one on both |psi> and H|psi>. At each parameterised
+        gate the gradient is just 2 * Re(<bra|D|psi>) where D is the derivative
+        of the gate, so only O(n_gates) kernel applications are needed instead of
+        a full circuit run per parameter as in get_gradients. Blocks sharing a
+        parameter are undone gate by gate, adding each gate's term as it's reached.
+        Returns:
+            gradients: list of dE/dtheta_i for each parameter in the circuit
+        """
+        psi: np.ndarray = self._forward()
+        bra: np.ndarray = self._apply_H(psi).reshape((2,) * self.n_qubits)
+        psi = psi.reshape((2,) * self.n_qubits)
+
+        gradients: list[float] = []
+        for g, ops in zip(self.gates[::-1], self._ops[::-1]):
+            gate_gradients: list[float] = [0] * (g.param_count if g.is_param else 0)
+            for op in ops[::-1]: #psi is the circuit state just after op
+                if g.is_param and op.is_param:
+                    for i, deriv in enumerate(self._derivatives(op)):
+                        d_psi: np.ndarray = sum(apply_kernel(kernel, psi, wires, xp=self.xp) for kernel, wires in deriv)
+                        gate_gradients[i] += 2 * float(self.xp.real(self.xp.vdot(bra, d_psi)))
+                dagger: Kernel = op._kernel.conj().T
+                psi = apply_kernel(dagger, psi, op._wires, xp=self.xp, diagonal=op._is_diagonal, perms=op._perms)
+                bra = apply_kernel(dagger, bra, op._wires, xp=self.xp, diagonal=op._is_diagonal, perms=op._perms)
+            gradients += gate_gradients[::-1]
+        return gradients[::-1]
+
+    @staticmethod
+    def _derivatives(g: Gate) -> list[Derivative]:
+        """Derivative of a single gate w.r.t each of its parameters in order."""
+        if g.param_count == 1:
+            return [g.derivative()]
+        return [g.parameterised_derivative(p) for p in range(1, g.param_count + 1)]
+
+    def _run_ops(self, psi: np.ndarray, ops: Union[Layer, Ops]) -> np.ndarray:
+        """Act a list of gates (or of (kernel, wires)) on a state of shape (2,)*N."""
+        for op in ops:
+            if isinstance(op, Gate):
+                psi = apply_kernel(op._kernel, psi, op._wires, xp=self.xp, diagonal=op._is_diagonal, perms=op._perms)
+            else:
+                psi = apply_kernel(op[0], psi, op[1], xp=self.xp)
+        return psi
+
+    def get_gradients_pshift(self) -> list[float]:
+        """Get the gradient of the energy <psi|H|psi> w.r.t each parameter using
+        the parameter shift rule: for a gate exp(-i*theta*G/2) with G^2 = I,
+        dE/dtheta = (E(theta + pi/2) - E(theta - pi/2)) / 2 exactly. Only the
+        kernels of the gates are used, so it's still right if flip_pauli has
+        changed the gates' derivatives. The state before each gate is kept
+        as the circuit is swept through so only the rest of the circuit is rerun
+        for each shift. Each gate in a block sharing a parameter is shifted in
+        turn and the results summed. Gates the rule doesn't hold for (fSim,
+        ARBGATE) use their derivative as in get_gradients_adjoint.
+        Returns:
+            gradients: list of dE/dtheta_i for each parameter in the circuit
+        """
+        psi_out: np.ndarray = self._forward()
+        h_psi: np.ndarray = self._apply_H(psi_out)
+        psi: np.ndarray = self.initial_state_arr.reshape((2,) * self.n_qubits) #circuit state before g
+
+        gradients: list[float] = []
+        for j, (g, ops) in enumerate(zip(self.gates, self._ops)):
+            rest: Layer = flatten(self._ops[j + 1:])
+            if g.is_param and g.param_count == 1 and all(op._shift_rule for op in ops if op.is_param):
+                gradient: float = 0
+                for k, op in enumerate(ops):
+                    if not op.is_param:
+                        continue
+                    for shift, sign in ((np.pi / 2, 1), (-np.pi / 2, -1)):
+                        shifted: Union[Layer, Ops] = ops[:k] + op.shifted_ops(shift) + ops[k + 1:]
+                        psi_shift: np.ndarray = self._run_ops(self._run_ops(psi, shifted), rest)
+                        gradient += sign * self._energy(psi_shift.reshape(-1)) / 2
+                gradients.append(gradient)
+            elif g.is_param:
+                gate_gradients: list[float] = [0] * g.param_count
+                for k, op in enumerate(ops):
+                    if not op.is_param:
+                        continue
+                    psi_k: np.ndarray = self._run_ops(psi, ops[:k + 1])
+                    for i, deriv in enumerate(self._derivatives(op)):
+                        d_psi: np.ndarray = self._run_ops(sum(self._run_ops(psi_k, [term]) for term in deriv), ops[k + 1:] + rest)
+                        gate_gradients[i] += 2 * float(self.xp.real(self.xp.vdot(h_psi, d_psi.reshape(-1))))
+                gradients += gate_gradients
+            psi = self._run_ops(psi, ops)
+        return gradients
+
+    def build_jax(self) -> Tuple[Callable, Callable]:
+        """Compile the circuit with jax (optional dependency). Every gate's kernel
+        is rebuilt from the parameters with jax.numpy so XLA can fuse the whole
+        circuit and differentiate it. Compiling is slow so this is only worth it
+        for many evaluations, i.e training loops. The circuit's gates are traced
+        when first called: call build_jax again if the layers or H are changed.
+        jax works in single precision unless jax_enable_x64 is set, so a
+        complex128 circuit needs jax.config.update("jax_enable_x64", True)
+        before building (or use dtype=np.complex64).
+        Returns:
+            run: jitted function of the parameter array -> flat circuit state
+            value_and_grad: jitted function of the parameter array -> (<psi|H|psi>, gradient)
+        """
+        import jax
+        import jax.numpy as jnp
+        from jax.experimental import sparse
+        if self.dtype == np.complex128 and not jax.config.jax_enable_x64:
+            raise Exception("complex128 circuits need jax_enable_x64 set, either call "
+                            "jax.config.update('jax_enable_x64', True) or use dtype=np.complex64")
+
+        N: QubitNumber = self.n_qubits
+        ops: list[Tuple[Gate, int]] = [] #each gate with the index of its first parameter
+        param_counter: int = 0
+        for g in self.gates:
+            ops.append((g, param_counter))
+            param_counter += g.param_count if g.is_param else 0
+        psi_0 = jnp.asarray(self._to_numpy(self.initial_state_arr)).reshape((2,) * N)
+        if self._h_diag is not None:
+            h_diag = jnp.asarray(self._to_numpy(self._h_diag))
+            apply_H = lambda psi: h_diag * psi
+        else:
+            H_sparse = sparse.BCOO.from_scipy_sparse(self.H.data.astype(self.dtype))
+            apply_H = lambda psi: H_sparse @ psi
+
+        def run(params):
+            psi = psi_0
+            for g, start in ops:
+                for kernel, wires in g.kernel_ops(params[start:start + g.param_count], xp=jnp):
+                    psi = apply_kernel(kernel, psi, wires, xp=jnp, diagonal=g._is_diagonal)
+            return psi.reshape(-1)
+
+        def energy(params):
+            psi = run(params)
+            return jnp.real(jnp.vdot(psi, apply_H(psi)))
+
+        return jax.jit(run), jax.jit(jax.value_and_grad(energy))
+
     def __repr__(self) -> str:
         line = f"A {self.n_qubits} qubit, {self.n_layers} layer deep PQC. \n"
         for count, l in enumerate(self.layers):
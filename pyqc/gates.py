@@ -4,15 +4,22 @@ import operator
 
 from itertools import permutations
 from copy import copy, deepcopy
-from functools import reduce
+from collections import OrderedDict
+from functools import reduce, lru_cache
 from typing import Tuple, Union, Type, Literal
 from typing_extensions import TypeAlias
+from qutip.qip.operations import expand_operator
+from .kernels import NUMBA_AVAILABLE, apply_1q, apply_2q, apply_diag_1q, apply_diag_2q
 
 rng = np.random.default_rng(1)
+# Number of angles a gate remembers the kernel of (see Gate._cached_kernel)
+KERNEL_CACHE_SIZE: int = 8
 #%% =============================TYPES=============================
 QuantumGate = Union['Gate', qt.Qobj]
 DoubleParamGate = 'fSim'
 Gradient: TypeAlias = qt.Qobj
+# Small (2^k x 2^k) matrix of a gate acting on k qubits
+Kernel: TypeAlias = np.ndarray
 # Won't use more than 20 qubits in simulations
 QubitIndex = int #Literal[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19]
 QubitList = Union[list[QubitIndex], tuple[QubitIndex, ...]]
@@ -20,6 +27,11 @@ QubitList = Union[list[QubitIndex], tuple[QubitIndex, ...]]
 QubitNumber = int #Literal[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
 Angle = Union[int, float]
 
+# Sum of (kernel, wires) terms, acts on the state after the gate it's the derivative of
+Derivative: TypeAlias = list[Tuple[Kernel, QubitList]]
+# (kernel, wires) a gate acts on the state one after the other
+Ops: TypeAlias = list[Tuple[Kernel, QubitList]]
+
 Layer = list['Gate']
 RotationLayer = list['PRot']
 EntanglingLayer = list['EntGate']
@@ -44,20 +56,171 @@ def iden(N: QubitNumber) -> qt.Qobj:
     return qt.tensor([qt.qeye(2) for i in range(N)])
 
 
+def z_string_diag(qubits: QubitList, N: QubitNumber) -> np.ndarray:
+    """Diagonal of the tensor product of sigma_z on each of qubits, i.e +1 or -1
+    depending on the parity of those qubits' bits in each basis state. Qubit 0
+    is the most significant bit, as in genFockOp."""
+    bits: np.ndarray = np.arange(2**N)
+    parity: np.ndarray = np.zeros(2**N, dtype=int)
+    for q in qubits:
+        parity ^= (bits >> (N - 1 - q)) & 1
+    return np.where(parity == 1, -1.0, 1.0)
+
+
+def build_kernel(rows: list[list], xp=np, batched: bool=False) -> Kernel:
+    """Make a complex kernel from a nested list of its entries. If batched the
+    entries may be arrays of the same leading shape (one entry per angle in a
+    batch of angles) or plain numbers, which are broadcast together to give a
+    batch of kernels with the batch axes first."""
+    if not batched:
+        return xp.array(rows) + 0j
+    dim: int = len(rows)
+    entries = xp.broadcast_arrays(*[xp.asarray(e) for row in rows for e in row])
+    kernel = xp.stack(entries, axis=-1)
+    return kernel.reshape(kernel.shape[:-1] + (dim, dim)) + 0j
+
+
+def expand_kernel(kernel: Kernel, wires: QubitList, N: QubitNumber) -> qt.Qobj:
+    """Expand a kernel acting on wires to a qutip operator on all N qubits."""
+    k: int = len(wires)
+    return expand_operator(qt.Qobj(kernel, dims=[[2] * k, [2] * k]), N, wires)
+
+
+@lru_cache(maxsize=None)
+def axis_permutations(wires: Tuple[QubitIndex, ...], N: QubitNumber) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """Get the axis order that moves wires to the front of a (2,)*N tensor and
+    the inverse order that puts them back. Cached as wires are fixed per gate."""
+    rest: Tuple[int, ...] = tuple(i for i in range(N) if i not in wires)
+    fwd_perm: Tuple[int, ...] = tuple(wires) + rest
+    inv_perm: Tuple[int, ...] = tuple(int(i) for i in np.argsort(fwd_perm))
+    return fwd_perm, inv_perm
+
+
+def apply_diag(phases: np.ndarray, psi: np.ndarray, wires: QubitList, xp=np) -> np.ndarray:
+    """Act a diagonal kernel, given by its diagonal phases, on the wires of a
+    statevector of shape (2,)*N. Each amplitude is just multiplied by the phase
+    picked out by its wire bits - the phases are reshaped to broadcast along the
+    wire axes so it is a single elementwise pass with no transposes."""
+    N: QubitNumber = psi.ndim
+    k: int = len(wires)
+    if xp is np and NUMBA_AVAILABLE and k <= 2:
+        flat: np.ndarray = np.ascontiguousarray(psi).reshape(-1)
+        out: np.ndarray = np.empty_like(flat)
+        phases = np.ascontiguousarray(phases, dtype=psi.dtype)
+        if k == 1:
+            apply_diag_1q(phases, flat, out, N - 1 - wires[0])
+        else:
+            apply_diag_2q(phases, flat, out, N - 1 - wires[0], N - 1 - wires[1])
+        return out.reshape(psi.shape)
+    phases = xp.asarray(phases, dtype=psi.dtype).reshape((2,) * k).transpose(np.argsort(wires))
+    broadcast_shape: list[int] = [2 if i in wires else 1 for i in range(N)]
+    return psi * phases.reshape(broadcast_shape)
+
+
+def apply_kernel_batch(kernel: Kernel, psi: np.ndarray, wires: QubitList, xp=np, diagonal: bool=False) -> np.ndarray:
+    """apply_kernel for a batch of states of shape (B, 2, ..., 2). kernel is
+    either one kernel for every state or a (B, 2^k, 2^k) batch of kernels, one
+    per state - the matmul broadcasts over the batch so it's one call for all B."""
+    N: QubitNumber = psi.ndim - 1
+    k: int = len(wires)
+    if diagonal:
+        phases = xp.diagonal(kernel, axis1=-2, axis2=-1)
+        batch_shape: Tuple[int, ...] = phases.shape[:-1]
+        phases = phases.reshape(batch_shape + (2,) * k)
+        phases = phases.transpose(tuple(range(len(batch_shape))) + tuple(len(batch_shape) + i for i in np.argsort(wires)))
+        broadcast_shape: list[int] = [2 if i in wires else 1 for i in range(N)]
+        return psi * phases.reshape((-1,) + tuple(broadcast_shape)).astype(psi.dtype)
+    fwd_perm, inv_perm = axis_permutations(tuple(wires), N)
+    fwd_perm = (0,) + tuple(i + 1 for i in fwd_perm) #batch axis stays first
+    inv_perm = (0,) + tuple(i + 1 for i in inv_perm)
+    unfolded: np.ndarray = psi.transpose(fwd_perm).reshape(psi.shape[0], 2**k, -1)
+    kernel = xp.asarray(kernel, dtype=psi.dtype)
+    return (kernel @ unfolded).reshape(psi.shape).transpose(inv_perm)
+
+
+def apply_kernel(kernel: Kernel, psi: np.ndarray, wires: QubitList, xp=np, diagonal: bool=False,
+                 perms: Union[Tuple[Tuple[int, ...], Tuple[int, ...]], None]=None) -> np.ndarray:
+    """Act a k qubit kernel on the wires of a statevector of shape (2,)*N by
+    unfolding the state: move the wire axes to the front, reshape to a
+    (2^k, 2^(N-k)) matrix, multiply by the kernel then fold back. Costs
+    O(2^k * 2^N) rather than the O(4^N) of multiplying by the full operator.
+    1 and 2 qubit kernels use the numba loops in kernels.py when available.
+    xp is the array module of psi - anything other than numpy (i.e jax.numpy)
+    always takes the unfolding path. Diagonal kernels go to apply_diag. perms
+    is the output of axis_permutations for wires, if already known."""
+    if diagonal:
+        return apply_diag(xp.diagonal(kernel), psi, wires, xp=xp)
+    N: QubitNumber = psi.ndim
+    k: int = len(wires)
+    if xp is np and NUMBA_AVAILABLE and k <= 2:
+        flat: np.ndarray = np.ascontiguousarray(psi).reshape(-1)
+        out: np.ndarray = np.empty_like(flat)
+        kernel = np.ascontiguousarray(kernel, dtype=psi.dtype)
+        if k == 1:
+            apply_1q(kernel, flat, out, N - 1 - wires[0])
+        else:
+            apply_2q(kernel, flat, out, N - 1 - wires[0], N - 1 - wires[1])
+        return out.reshape(psi.shape)
+    fwd_perm, inv_perm = perms if perms is not None else axis_permutations(tuple(wires), N)
+    unfolded: np.ndarray = psi.transpose(fwd_perm).reshape(2**k, -1)
+    kernel = xp.asarray(kernel, dtype=psi.dtype) #don't upcast complex64 states
+    return (kernel @ unfolded).reshape((2,) * N).transpose(inv_perm)
+
+
 class Gate():
     """Parent class for all gate types to inherit from - describes the behaviour
     when any Gate (or derived classes) is multiplied. Want to ensure that the
     gate always uses its underlying qutip gate representation when multiplied
-    or added, so overwrite the mul, rmul (*) and add, radd (+) functions."""
+    or added, so overwrite the mul, rmul (*) and add, radd (+) functions.
+
+    Each gate stores only a small kernel and the wires (qubits) it acts on - the
+    full 2^N x 2^N qutip operation is only built when asked for."""
+
+    # Last angle passed to set_theta - lets it skip rebuilding the kernel if unchanged
+    _last_theta: Union[Angle, None] = None
+    # Kernel is diagonal in the computational basis so can be applied elementwise
+    _is_diagonal: bool = False
+    # Angle changed since the kernel was last built
+    _dirty: bool = False
+    # axis_permutations of the wires, set by PQC.set_gates
+    _perms: Union[Tuple[Tuple[int, ...], Tuple[int, ...]], None] = None
+    # Generator has eigenvalues +-1/2 so the parameter shift rule holds (see PQC.get_gradients_pshift)
+    _shift_rule: bool = False
+    # Array module the kernel is kept in, set by PQC.set_gates (cupy keeps it on the GPU)
+    _xp = np
 
     def __init__(self, q_N: QubitNumber) -> None:
         self.q_N: QubitNumber = q_N
-        self.operation: qt.Qobj = iden(q_N)
+        self._wires: QubitList = list(range(q_N))
+        self._kernel: Kernel = np.eye(2**q_N)
         self.param_count: int = 0
         self.is_param: bool = False
         self.theta: Angle = 0
         self.phi: Angle = 0
 
+    @property
+    def _kernel(self) -> Kernel:
+        """The gate's kernel. set_theta/set_phi only mark the gate as dirty, the
+        kernel is rebuilt when next used so setting every angle of a circuit
+        is cheap and a gate whose angles all change only rebuilds once. The
+        kernel is moved to _xp when built, not every time it is applied."""
+        if self._dirty:
+            self._kernel = self._rebuild_kernel()
+        return self._kernel_arr
+
+    @_kernel.setter
+    def _kernel(self, kernel: Kernel) -> None:
+        self._kernel_arr: Kernel = kernel if self._xp is np else self._xp.asarray(kernel)
+        self._dirty = False
+
+    def _rebuild_kernel(self) -> Kernel:
+        return self.get_kernel()
+
+    @property
+    def operation(self) -> qt.Qobj:
+        """Expand the kernel to a qutip operator acting on all q_N qubits."""
+        return expand_kernel(self._kernel, self._wires, self.q_N)
+
     def __mul__(self, b: QuantumGate) -> QuantumGate:
         if isinstance(b, Gate):
             return self.operation * b.operation
@@ -85,18 +248,61 @@ class Gate():
     def set_theta(self, theta: Angle) -> None:
         return
 
+    def _theta_changed(self, theta: Angle) -> bool:
+        """Record theta as the last angle set, returning False if it was already
+        the last one - set_theta calls this first so it can skip unchanged angles."""
+        if theta == self._last_theta:
+            return False
+        self._last_theta = theta
+        return True
+
     def set_phi(self, phi: Angle) -> None:
         return
 
-    def derivative(self) -> Gradient:
-        return iden(self.q_N)
+    def _cached_kernel(self, angle: Angle) -> Kernel:
+        """get_kernel() memoised on angle for the KERNEL_CACHE_SIZE most recently
+        used angles. Worth it for gates whose kernel is expensive to build, as
+        optimisers often revisit the same angles."""
+        if "_kernel_cache" not in self.__dict__:
+            self._kernel_cache: OrderedDict[Angle, Kernel] = OrderedDict()
+        cache = self._kernel_cache
+        if angle in cache:
+            cache.move_to_end(angle)
+        else:
+            cache[angle] = self.get_kernel()
+            if len(cache) > KERNEL_CACHE_SIZE:
+                cache.popitem(last=False)
+        return cache[angle]
+
+    def kernel_ops(self, params: list[Angle], xp=np) -> Ops:
+        """The kernels the gate acts on the state, as a pure function of its
+        param_count circuit parameters built with the array module xp (numpy or
+        jax.numpy) - lets PQC.build_jax trace the whole circuit."""
+        if self.param_count == 0:
+            return [(xp.asarray(self._kernel), self._wires)]
+        return [(self.kernel_fn(*params, xp=xp), self._wires)]
+
+    def derivative(self) -> Derivative:
+        return [(np.eye(2**len(self._wires)), self._wires)]
     
-    def parameterised_derivative(self, param: Literal[1,2]) -> Gradient:
+    def parameterised_derivative(self, param: Literal[1,2]) -> Derivative:
         return self.derivative()
 
     def flip_pauli(self) -> None:
         pass
 
+    def as_layer(self) -> Layer:
+        """The gates this gate is made of, in the order they act."""
+        return [self]
+
+    def clone(self) -> 'Gate':
+        """Copy of the gate for use in another layer. Much cheaper than deepcopy:
+        kernels are never modified in place so can be shared between copies."""
+        new: Gate = copy(self)
+        if "_kernel_cache" in self.__dict__:
+            new._kernel_cache = OrderedDict(self._kernel_cache)
+        return new
+
 #%% Rotation gates
 
 
@@ -105,34 +311,48 @@ class PRot(Gate):
     qubit they operate on, a total number of qubits in the system (so gate can
     be extended to that dimension) and an angle that the gate rotates by."""
 
+    _shift_rule: bool = True
+
     def __init__(self, q_on: QubitIndex, q_N: QubitNumber) -> None:
         self.q_on: QubitIndex = q_on
         self.q_N: QubitNumber = q_N
         self.theta: Angle = 0
         self.is_param: bool = True
         self.param_count: int = 1
+        self._wires: QubitList = [q_on]
 
         self.set_properties()
-        self.fock: qt.Qobj = genFockOp(self.pauli, self.q_on, self.q_N, 2)
-        self.operation: qt.Qobj = self.get_op()
+        self._kernel: Kernel = self.get_kernel()
 
-    def get_op(self) -> qt.Qobj:
-        return self.gate(self.theta, N=self.q_N, target=self.q_on)
+    def get_kernel(self) -> Kernel:
+        return self.kernel_fn(self.theta)
+
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel:
+        """Kernel for angle theta. Subclasses give closed forms in terms of xp
+        so they can be traced by jax, this falls back to qutip."""
+        return xp.asarray(self.gate(theta).full())
     
     def set_properties(self) -> None:
         self.gate: qt.Qobj = iden
         self.pauli: qt.Qobj = iden
 
     def set_theta(self, theta: Angle) -> None:
+        if not self._theta_changed(theta):
+            return
         self.theta = theta
-        self.operation = self.get_op()
+        self._dirty = True
 
-    def derivative(self) -> Gradient:
+    def derivative(self) -> Derivative:
         """Take the derivative of the PRot - this generates the pauli gate
         associated with the gate type (i.e R_x -> sigma_x) operating on given
-        qubit and multiplies it by j/2."""
-        deriv: qt.Qobj = -1j * self.fock / 2
-        return deriv
+        qubit and multiplies it by j/2. Only the 2x2 pauli is stored, with the
+        qubit it acts on."""
+        deriv: Kernel = -1j * self.pauli.full() / 2
+        return [(deriv, self._wires)]
+
+    def shifted_ops(self, shift: Angle) -> Ops:
+        """Kernel of the gate with its parameter shifted by shift."""
+        return [(self.kernel_fn(self.theta + shift), self._wires)]
 
     def flip_pauli(self) -> None:
         self.pauli = -1 * self.pauli
@@ -144,12 +364,14 @@ class PRot(Gate):
         return string
 
 class I(PRot):
+    _is_diagonal: bool = True
+
     def set_properties(self) -> None:
         self.gate: qt.Qobj = iden
-        self.pauli: qt.Qobj = iden(self.q_N)
+        self.pauli: qt.Qobj = qt.qeye(2)
 
-    def get_op(self) -> qt.Qobj:
-        return iden(self.q_N)
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel:
+        return xp.eye(2) + 0j
     
 
 class R_x(PRot):
@@ -157,29 +379,52 @@ class R_x(PRot):
         self.gate: qt.Qobj = qt.qip.operations.rx
         self.pauli: qt.Qobj = qt.sigmax()
 
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel:
+        """Closed form of exp(-i * theta * sigma_x / 2) - much quicker than asking qutip."""
+        c, s = xp.cos(theta / 2), xp.sin(theta / 2)
+        return build_kernel([[c, -1j * s], [-1j * s, c]], xp, batched=xp.ndim(theta) > 0)
+
 
 class R_y(PRot):
     def set_properties(self) -> None:
         self.gate: qt.Qobj = qt.qip.operations.ry
         self.pauli: qt.Qobj = qt.sigmay()
 
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel:
+        c, s = xp.cos(theta / 2), xp.sin(theta / 2)
+        return build_kernel([[c, -s], [s, c]], xp, batched=xp.ndim(theta) > 0)
+
 
 class R_z(PRot):
+    _is_diagonal: bool = True
+
     def set_properties(self) -> None:
         self.gate: qt.Qobj = qt.qip.operations.rz
         self.pauli: qt.Qobj = qt.sigmaz()
 
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel:
+        phase: complex = xp.exp(-0.5j * theta)
+        return build_kernel([[phase, 0], [0, xp.conj(phase)]], xp, batched=xp.ndim(theta) > 0)
+
 
 #%% Fermionic specific gates
 
 class negative_R_z(R_z):
     def set_theta(self, theta: Angle) -> None:
+        if not self._theta_changed(theta):
+            return
         self.theta = -1 * theta
-        self.operation = self.get_op()
+        self._dirty = True
+
+    def kernel_ops(self, params: list[Angle], xp=np) -> Ops:
+        return [(self.kernel_fn(-1 * params[0], xp=xp), self._wires)]
+
+    def shifted_ops(self, shift: Angle) -> Ops:
+        return [(self.kernel_fn(self.theta - shift), self._wires)]
     
-    def derivative(self) -> Gradient:
-        deriv: qt.Qobj = 1j * self.fock / 2
-        return deriv
+    def derivative(self) -> Derivative:
+        deriv: Kernel = 1j * self.pauli.full() / 2
+        return [(deriv, self._wires)]
 
 
 class offset_R_z(R_z):
@@ -190,21 +435,27 @@ class offset_R_z(R_z):
         self.offset: Angle = offset 
         self.is_param: bool = True
         self.param_count: int = 1
-
+        self._wires: QubitList = [q_on]
 
         self.set_properties()
-        self.fock: qt.Qobj = genFockOp(self.pauli, self.q_on, self.q_N, 2)
-        self.operation: qt.Qobj = self.get_op()
+        self._kernel: Kernel = self.get_kernel()
 
     def set_theta(self, theta: Angle):
+        if not self._theta_changed(theta):
+            return
         self.theta = theta + self.offset
-        self.operation = self.get_op() 
+        self._dirty = True
+
+    def kernel_ops(self, params: list[Angle], xp=np) -> Ops:
+        return [(self.kernel_fn(params[0] + self.offset, xp=xp), self._wires)]
 
 #%% Fixed angle single-qubit rotations
 
 
 class H(PRot):
-    """Hadamard gate."""
+    """Hadamard gate. Fixed single qubit gates store their kernel once per class
+    in KERNEL."""
+    KERNEL: Kernel = np.array([[1, 1], [1, -1]], dtype=complex) / np.sqrt(2) #sigma_x * R_y(pi/2)
 
     def __init__(self, q_on: QubitIndex, q_N: QubitNumber) -> None:
         self.q_on: QubitIndex = q_on
@@ -212,30 +463,23 @@ class H(PRot):
         self.theta: Angle = np.pi / 2
         self.is_param: bool = False
         self.param_count: int = 0
-        self.operation: qt.Qobj = self.get_op()
+        self._wires: QubitList = [q_on]
+        self._kernel: Kernel = self.get_kernel()
 
     def set_theta(self, angle: Angle) -> None:
         """angle added as argument but not used in case we call set_theta on this class."""
         return None
 
-    def get_op(self) -> qt.Qobj:
-        """Hadamard gate is just sigma_x * R_y(pi/2)"""
-        ops = qt.qip.operations
-        self.gate: qt.Qobj = ops.ry
-        return ops.x_gate(self.q_N, self.q_on) * self.gate(np.pi / 2, N=self.q_N, target=self.q_on)
+    def get_kernel(self) -> Kernel:
+        return self.KERNEL
 
 
 class sqrtH(H):
-    def get_op(self) -> qt.Qobj:
-        ops = qt.qip.operations
-        self.gate: qt.Qobj = ops.ry
-        return np.sqrt(ops.x_gate(self.q_N, self.q_on) * self.gate(np.pi / 2, N=self.q_N, target=self.q_on))
+    KERNEL: Kernel = qt.Qobj(H.KERNEL).sqrtm().full()
 
 class X(H):
-    def get_op(self) -> qt.Qobj:
-        """Pauli X gate"""
-        ops = qt.qip.operations
-        return ops.x_gate(self.q_N, self.q_on)
+    """Pauli X gate"""
+    KERNEL: Kernel = np.array([[0, 1], [1, 0]], dtype=complex)
 
 
 class fixed_R_y(R_y):
@@ -248,8 +492,9 @@ class fixed_R_y(R_y):
         self.theta: Angle = theta
         self.is_param: bool = False
         self.param_count: int = 0
+        self._wires: QubitList = [q_on]
         self.set_properties()
-        self.operation: qt.Qobj = self.get_op()
+        self._kernel: Kernel = self.get_kernel()
 
     def set_theta(self, theta: Angle) -> None:
         return None
@@ -265,28 +510,23 @@ class fixed_R_z(R_z):
         self.theta: Angle = theta
         self.is_param: bool = False
         self.param_count: int = 0
+        self._wires: QubitList = [q_on]
         self.set_properties()
-        self.operation: qt.Qobj = self.get_op()
+        self._kernel: Kernel = self.get_kernel()
 
     def set_theta(self, theta: Angle) -> None:
         return None
 
 
 class S(H):
-    def get_op(self) -> qt.Qobj:
-        self.theta = np.pi / 2
-        ops = qt.qip.operations
-        self.gate = ops.phasegate
-        return self.gate(np.pi / 2, N=self.q_N, target=self.q_on)
+    _is_diagonal: bool = True
+    KERNEL: Kernel = np.array([[1, 0], [0, 1j]])
 
 
 class T(H):
     """T-gate."""
-
-    def get_op(self) -> qt.Qobj:
-        ops = qt.qip.operations
-        self.gate = ops.t_gate
-        return self.gate(N=self.q_N, target=self.q_on)
+    _is_diagonal: bool = True
+    KERNEL: Kernel = np.array([[1, 0], [0, np.exp(1j * np.pi / 4)]])
 
 #%% Entangling gates
 
@@ -294,47 +534,42 @@ class T(H):
 class EntGate(Gate):
     """A class to described how entangling gates work - they have the
     qubits they operate on (control and target) and a total number of qubits
-    in the system. Works the same way as rotation gates, i.e changing the
-    get_op() method to use the right qutip gate."""
+    in the system. The 4x4 kernel doesn't depend on the qubits so is stored
+    once per class in KERNEL."""
+    KERNEL: Kernel = np.eye(4)
 
     def __init__(self, qs_on: QubitList, q_N: QubitNumber) -> None:
         self.q1, self.q2 = qs_on[0], qs_on[1]
         self.q_N: QubitNumber = q_N
         self.is_param: bool = False
         self.param_count: int = 0
-        self.operation: qt.Qobj = self.get_op()
+        self._wires: QubitList = [self.q1, self.q2]
+        self._kernel: Kernel = self.get_kernel()
 
-    def get_op(self) -> qt.Qobj:
-        self.gate = qt.qeye
-        return qt.qeye(self.q_N)
+    def get_kernel(self) -> Kernel:
+        return self.KERNEL
 
     def __repr__(self) -> str:
         return f"{type(self).__name__}@q{self.q1},q{self.q2}"
 
 
 class CNOT(EntGate):
-    def get_op(self) -> qt.Qobj:
-        gate = qt.qip.operations.cnot
-        return gate(self.q_N, self.q1, self.q2)
+    KERNEL: Kernel = qt.qip.operations.cnot().full()
 
 
 class CPHASE(EntGate):
-    def get_op(self) -> qt.Qobj:
-        """The CPHASE gate not a real cphase gate, defined in papers as CZ gate."""
-        gate = qt.qip.operations.cz_gate
-        return gate(self.q_N, self.q1, self.q2)
+    """The CPHASE gate not a real cphase gate, defined in papers as CZ gate."""
+    _is_diagonal: bool = True
+    KERNEL: Kernel = qt.qip.operations.cz_gate().full()
 
 
 class sqrtiSWAP(EntGate):
-    def get_op(self) -> qt.Qobj:
-        gate = qt.qip.operations.sqrtiswap
-        return gate(self.q_N, [self.q1, self.q2])
+    KERNEL: Kernel = qt.qip.operations.sqrtiswap().full()
 
 
 class CZ(EntGate):
-    def get_op(self) -> qt.Qobj:
-        gate = qt.qip.operations.cz_gate
-        return gate(self.q_N, self.q1, self.q2)
+    _is_diagonal: bool = True
+    KERNEL: Kernel = qt.qip.operations.cz_gate().full()
     
 
 #%% Block entangling gates
@@ -342,22 +577,37 @@ class CZ(EntGate):
 
 class CHAIN(EntGate):
     """Can make a Chain of a given entangling gate by generating all indices
-    and making an entangler between all these indices."""
+    and making an entangler between all these indices. The entanglers are kept
+    as a list of 2 qubit gates (PQC.set_gates expands the chain into them) so
+    the chain is never multiplied out into a 2^N x 2^N operator."""
 
     def __init__(self, entangler: Type[EntGate], q_N: QubitNumber) -> None:
         self.entangler: Type[EntGate] = entangler
         self.q_N: QubitNumber = q_N
         self.is_param: bool = False
         self.param_count: int = 0
-        self.operation: qt.Qobj = self.get_op()
+        self._wires: QubitList = list(range(q_N))
+        self.layer: EntanglingLayer = self.gen_layer()
 
-    def get_op(self) -> qt.Qobj:
+    def gen_layer(self) -> EntanglingLayer:
         N: QubitNumber = self.q_N
         top_connections: list[QubitList] = [[2 * j, 2 * j + 1] for j in range(N // 2)]
         bottom_connections: list[QubitList] = [[2 * j + 1, 2 * j + 2] for j in range((N - 1) // 2)]
         indices: list[QubitList] = top_connections + bottom_connections
-        entangling_layer: qt.Qobj = prod([self.entangler(index_pair, N) for index_pair in indices][::-1])
-        return entangling_layer
+        return [self.entangler(index_pair, N) for index_pair in indices]
+
+    def as_layer(self) -> Layer:
+        return self.layer
+
+    def clone(self) -> Gate:
+        new: Gate = super().clone()
+        new.layer = [g.clone() for g in self.layer]
+        return new
+
+    @property
+    def operation(self) -> qt.Qobj:
+        ops: list[qt.Qobj] = [g.operation for g in self.layer[::-1]]
+        return reduce(operator.mul, ops, iden(self.q_N))
 
     def __repr__(self) -> str:
         return f"CHAIN connected {self.entangler.__name__}s"
@@ -371,13 +621,26 @@ class ALLTOALL(EntGate):
         self.q_N: QubitNumber = q_N
         self.is_param: bool = False
         self.param_count: int = 0
-        self.operation: qt.Qobj = self.get_op()
+        self._wires: QubitList = list(range(q_N))
+        self.layer: EntanglingLayer = self.gen_layer()
 
-    def get_op(self) -> qt.Qobj:
+    def gen_layer(self) -> EntanglingLayer:
         N: QubitNumber = self.q_N
         indices = list(permutations(range(N), 2))
-        entangling_layer = prod([self.entangler(index_pair, N) for index_pair in indices][::-1])
-        return entangling_layer
+        return [self.entangler(index_pair, N) for index_pair in indices]
+
+    def as_layer(self) -> Layer:
+        return self.layer
+
+    def clone(self) -> Gate:
+        new: Gate = super().clone()
+        new.layer = [g.clone() for g in self.layer]
+        return new
+
+    @property
+    def operation(self) -> qt.Qobj:
+        ops = [g.operation for g in self.layer[::-1]]
+        return reduce(operator.mul, ops, iden(self.q_N))
 
     def __repr__(self):
         return f"ALL connected {self.entangler.__name__}s"
@@ -392,23 +655,35 @@ class ARBGATE(Gate):
         self.theta = 0
         self.is_param = True
         self.param_count: int = 1
-        self.operation = self.get_op()
+        self.q_N: QubitNumber = len(Ham.dims[0])
+        self._wires: QubitList = list(range(self.q_N))
+        # exp(-i*theta*Ham) = V exp(-i*theta*E) V^dag, so only the eigenvalues need exponentiating
+        self._eigvals, self._eigvecs = np.linalg.eigh(Ham.full())
+        self._kernel: Kernel = self.get_kernel()
  
-    def get_op(self) -> qt.Qobj:
-        exponent = (-1j*self.theta*self._Ham)
-        mat = exponent.expm()
-        return mat
+    def get_kernel(self) -> Kernel:
+        return self.kernel_fn(self.theta)
+
+    def _rebuild_kernel(self) -> Kernel:
+        return self._cached_kernel(self.theta)
+
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel:
+        eigvecs = xp.asarray(self._eigvecs)
+        phases = xp.exp(-1j * xp.asarray(theta)[..., None] * xp.asarray(self._eigvals))
+        return (eigvecs * phases[..., None, :]) @ eigvecs.conj().T
 
     def flip_pauli(self):
         self.pauli = -1 * self.pauli
          
     def set_theta(self, theta):
+        if not self._theta_changed(theta):
+            return
         self.theta = theta
-        self.operation = self.get_op()  
+        self._dirty = True
         
     def derivative(self):
-        deriv = -1j * self._Ham / 2
-        return deriv
+        deriv = -1j * self._Ham.full() #kernel is exp(-i*theta*Ham)
+        return [(deriv, self._wires)]
     
     def __repr__(self):
         name = type(self).__name__
@@ -422,6 +697,10 @@ class ARBGATE(Gate):
 
 
 class shared_parameter(PRot):
+    """Block of rotation gates that all share one parameter. Like CHAIN the
+    block is kept as its list of gates, which the PQC applies one by one, so is
+    never multiplied out into a 2^N x 2^N kernel."""
+
     def __init__(self, layer: RotationLayer, q_N: QubitNumber, commute: bool=True):
         self.layer = layer
         self.theta: Angle = 0
@@ -429,38 +708,44 @@ class shared_parameter(PRot):
         self.is_param: bool = True
         self.param_count: int = 1
         self.commute: bool = commute
-        self.operation: qt.Qobj = self.get_op()
-
-    def derivative(self) -> Gradient:
-        """H=sum(H_s) -> d_theta U = d_theta (e^i*H*theta) = sum(H_s * U)"""
-        deriv: qt.Qobj = 0
-        if self.commute is True: # can do this i.f.f all gates in layer commute
-            for g in self.layer:
-                single_deriv: qt.Qobj = g.derivative()
-                deriv = deriv + single_deriv
-        else:
-            for count, g in enumerate(self.layer):
-                current_gate_deriv: qt.Qobj = g.derivative()
-                new_layer: RotationLayer = copy(self.layer)
-                new_layer[count] = current_gate_deriv * new_layer[count]
-                deriv = deriv + prod(new_layer[::-1])
-            deriv = deriv * self.operation.conj() #in pqc.take_derivative we multiply by gates at the end, need to get rid of that
-        return deriv
+        self._wires: QubitList = list(range(q_N))
+
+    def derivative(self) -> Derivative:
+        """H=sum(H_s) -> d_theta U = d_theta (e^i*H*theta) = sum(H_s * U). Only
+        holds as terms after the whole block if all gates in the layer commute,
+        otherwise differentiate the gates of as_layer() one at a time."""
+        if not self.commute:
+            raise Exception("Derivative of a non-commuting block can't be written as terms after the block, "
+                            "differentiate each gate of as_layer() in turn")
+        return flatten([g.derivative() for g in self.layer])
 
     def set_theta(self, theta: Angle) -> None:
+        if not self._theta_changed(theta):
+            return
         self.theta = theta
         for gate in self.layer:
             gate.set_theta(theta)
-        self.operation = self.get_op()
 
-    def get_op(self) -> qt.Qobj:
-        operation = prod(self.layer[::-1])
-        return operation
+    def as_layer(self) -> Layer:
+        return self.layer
+
+    @property
+    def operation(self) -> qt.Qobj:
+        return prod([g.operation for g in self.layer[::-1]])
+
+    def kernel_ops(self, params: list[Angle], xp=np) -> Ops:
+        """Every gate in the block is given the shared parameter."""
+        return flatten([g.kernel_ops(params, xp=xp) for g in self.layer])
 
     def flip_pauli(self) -> None:
         for g in self.layer:
             g.flip_pauli()
 
+    def clone(self) -> Gate:
+        new: Gate = super().clone()
+        new.layer = [g.clone() for g in self.layer]
+        return new
+
     def __repr__(self) -> str:
         return f"Block of {self.layer}"
 
@@ -478,22 +763,21 @@ class RR(PRot):
         self.is_param = True
         self.param_count: int = 1
         self.set_properties()
-        self.fock1: qt.Qobj = genFockOp(self.pauli, self.q1, self.q_N, 2) #hmmmmm
-        self.fock2: qt.Qobj = genFockOp(self.pauli, self.q2, self.q_N, 2)
-        self._I = iden(self.q_N)
-        self.operation: qt.Qobj = self.get_op()
+        self._wires: QubitList = [self.q1, self.q2]
+        self._pauli_str: Kernel = np.kron(self.pauli.full(), self.pauli.full())
+        self._kernel: Kernel = self.get_kernel()
 
     def set_properties(self) -> None:
         self.gate: qt.Qobj = iden
         self.pauli: qt.Qobj = iden    
 
-    def get_op(self) -> qt.Qobj: #analytic expression for exponent of pauli is cos(x)*I + sin(x)*pauli_str
-        return np.cos(self.theta / 2) * self._I - 1j * np.sin(self.theta / 2) * self.fock1 * self.fock2
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel: #analytic expression for exponent of pauli is cos(x)*I + sin(x)*pauli_str
+        theta = xp.asarray(theta)[..., None, None] #so a batch of angles gives a batch of kernels
+        return xp.cos(theta / 2) * xp.eye(4) - 1j * xp.sin(theta / 2) * xp.asarray(self._pauli_str)
 
-    def derivative(self) -> Gradient:
+    def derivative(self) -> Derivative:
         """Derivative of XX/YY/ZZ is -i * tensor(sigmai, sigmai) /2"""
-        deriv = -1j * (self.fock1 * self.fock2) / 2
-        return deriv
+        return [(-1j * self._pauli_str / 2, self._wires)]
 
     def __repr__(self) -> str:
         name: str = type(self).__name__
@@ -502,26 +786,22 @@ class RR(PRot):
 
 
 class R_zz(RR):
+    _is_diagonal: bool = True
+
     def set_properties(self) -> None:
         self.gate: qt.Qobj = qt.qip.operations.rz
-        self.fock1 = qt.qip.operations.z_gate(N=self.q_N, target=self.q1)
-        self.fock2 = qt.qip.operations.z_gate(N=self.q_N, target=self.q2)
         self.pauli: qt.Qobj = qt.sigmaz()
 
 
 class R_xx(RR):
     def set_properties(self) -> None:
         self.gate: qt.Qobj = qt.qip.operations.rx
-        self.fock1 = qt.qip.operations.x_gate(N=self.q_N, target=self.q1)
-        self.fock2 = qt.qip.operations.x_gate(N=self.q_N, target=self.q2)
         self.pauli: qt.Qobj = qt.sigmax()
 
 
 class R_yy(RR):
     def set_properties(self) -> None:
         self.gate: qt.Qobj = qt.qip.operations.ry
-        self.fock1 = qt.qip.operations.y_gate(N=self.q_N, target=self.q1)
-        self.fock2 = qt.qip.operations.y_gate(N=self.q_N, target=self.q2)
         self.pauli: qt.Qobj = qt.sigmay()
 
 
@@ -533,7 +813,7 @@ class RR_block(shared_parameter):
         self.is_param: bool = True
         self.param_count: int = 1
         self.layer: RotationLayer = self.gen_layer()
-        self.operation: qt.Qobj = self.get_op()
+        self._wires: QubitList = list(range(q_N))
         self.commute = True
     
     def gen_layer(self):
@@ -545,16 +825,6 @@ class RR_block(shared_parameter):
         layer: RotationLayer = [self.rotator(index_pair, N) for index_pair in indices]
         return layer
     
-    def set_theta(self, theta: Angle) -> None:
-        self.theta = theta
-        for gate in self.layer:
-            gate.set_theta(theta)
-        self.operation = self.get_op()
-
-    def get_op(self) -> qt.Qobj:
-        operation = prod(self.layer[::-1])
-        return operation
-
     def __repr__(self) -> str:
         return f"RR block of {self.layer}"
     
@@ -577,10 +847,10 @@ def fsim_gate_d_theta(theta: Angle, phi: Angle, N=None, control: int=0, target:
 
     if N is not None:
         return qt.qip.operations.gate_expand_2toN(fsim_gate_d_theta(theta, phi), N, control, target)
-    return qt.Qobj([[1,                   0,                   0,                  0],
+    return qt.Qobj([[0,                   0,                   0,                  0],
                     [0,       -1 * np.sin(theta), -1j * np.cos(theta),                  0],
                     [0, -1j * np.cos(theta),      -1 *  np.sin(theta),                  0],
-                    [0,                   0,                   0, np.exp(-1j * phi)]],
+                    [0,                   0,                   0,                  0]],
                     dims=[[2, 2], [2, 2]])
 
 def fsim_gate_d_phi(theta: Angle, phi: Angle, N=None, control: int=0, target: int=1) -> qt.Qobj:
@@ -589,13 +859,15 @@ def fsim_gate_d_phi(theta: Angle, phi: Angle, N=None, control: int=0, target: in
 
     if N is not None:
         return qt.qip.operations.gate_expand_2toN(fsim_gate_d_phi(theta, phi), N, control, target)
-    return qt.Qobj([[1,                   0,                   0,                  0],
-                    [0,       np.cos(theta), -1j * np.sin(theta),                  0],
-                    [0, -1j * np.sin(theta),       np.cos(theta),                  0],
+    return qt.Qobj([[0,                   0,                   0,                  0],
+                    [0,                   0,                   0,                  0],
+                    [0,                   0,                   0,                  0],
                     [0,                   0,                   0, -1j * np.exp(-1j * phi)]],
                     dims=[[2, 2], [2, 2]])
 
 class fSim(PRot):
+    _shift_rule: bool = False
+
     def __init__(self, qs_on: QubitList, q_N: QubitNumber) -> None:
         self.q1, self.q2 = qs_on
         self.q_N: QubitNumber = q_N
@@ -603,27 +875,42 @@ class fSim(PRot):
         self.phi: Angle = 0
         self.is_param: bool = True
         self.param_count: int = 2
+        self._wires: QubitList = [self.q1, self.q2]
 
-        self.operation: qt.Qobj = self.get_op()
+        self._kernel: Kernel = self.get_kernel()
 
-    def get_op(self) -> qt.Qobj:
-        return fsim_gate(self.theta, self.phi, N=self.q_N, control=self.q1, target=self.q2)
+    def get_kernel(self) -> Kernel:
+        return self.kernel_fn(self.theta, self.phi)
+
+    def kernel_fn(self, theta: Angle, phi: Angle, xp=np) -> Kernel:
+        """Same matrix as fsim_gate."""
+        c, s = xp.cos(theta), -1j * xp.sin(theta)
+        return build_kernel([[1, 0, 0, 0],
+                             [0, c, s, 0],
+                             [0, s, c, 0],
+                             [0, 0, 0, xp.exp(-1j * phi)]], xp, batched=xp.ndim(theta) + xp.ndim(phi) > 0)
 
     def set_theta(self, theta: Angle) -> None:
+        if not self._theta_changed(theta):
+            return
         self.theta = theta
-        self.operation = self.get_op()
+        self._dirty = True
 
     def set_phi(self, phi: Angle) -> None:
+        if phi == self.phi:
+            return
         self.phi = phi
-        self.operation = self.get_op()
+        self._dirty = True
 
-    def parameterised_derivative(self, param: Literal[1,2]) -> Gradient: # can only take deriv w.r.t 1st or 2nd param so use literal type
+    def parameterised_derivative(self, param: Literal[1,2]) -> Derivative: # can only take deriv w.r.t 1st or 2nd param so use literal type
+        """Derivative terms act after the gate, so the derivative of the matrix
+        is multiplied by the inverse of the gate: dK/dx * K^dag."""
         deriv: qt.Qobj
         if param == 1: #i.e d_theta
-            deriv = fsim_gate_d_theta(self.theta, self.phi, N=self.q_N, control=self.q1, target=self.q2)
+            deriv = fsim_gate_d_theta(self.theta, self.phi)
         elif param == 2: #i.e d_phi
-            deriv = fsim_gate_d_phi(self.theta, self.phi, N=self.q_N, control=self.q1, target=self.q2)
-        return deriv
+            deriv = fsim_gate_d_phi(self.theta, self.phi)
+        return [(deriv.full() @ self.kernel_fn(self.theta, self.phi).conj().T, self._wires)]
 
     def flip_pauli(self) -> None:
         pass
@@ -653,27 +940,36 @@ def fixed_fsim_gate_d_theta(theta, N: int=None, control: int=0, target: int=1) -
 
     if N is not None:
         return qt.qip.operations.gate_expand_2toN(fixed_fsim_gate_d_theta(theta), N, control, target)
-    return qt.Qobj([[1,                   0,                   0,                  0],
+    return qt.Qobj([[0,                   0,                   0,                  0],
                     [0,       -1 * np.sin(theta), -1j * np.cos(theta),                  0],
                     [0, -1j * np.cos(theta),      -1 *  np.sin(theta),                  0],
-                    [0,                   0,                   0,                       1]],
+                    [0,                   0,                   0,                  0]],
                     dims=[[2, 2], [2, 2]])
 
 class fixed_fSim(PRot):
+    _shift_rule: bool = False
+
     def __init__(self, qs_on, q_N):
         self.q1, self.q2 = qs_on
         self.q_N: QubitNumber = q_N
         self.theta = 0
         self.is_param = True
         self.param_count: int = 1
+        self._wires: QubitList = [self.q1, self.q2]
 
-        self.operation = self.get_op()
+        self._kernel: Kernel = self.get_kernel()
 
-    def get_op(self) -> qt.Qobj:
-        return fixed_fsim_gate(self.theta, N=self.q_N, control=self.q1, target=self.q2)
+    def kernel_fn(self, theta: Angle, xp=np) -> Kernel:
+        """Same matrix as fixed_fsim_gate."""
+        c, s = xp.cos(theta), -1j * xp.sin(theta)
+        return build_kernel([[1, 0, 0, 0],
+                             [0, c, s, 0],
+                             [0, s, c, 0],
+                             [0, 0, 0, 1]], xp, batched=xp.ndim(theta) > 0)
     
-    def derivative(self) -> Gradient:
-        return fixed_fsim_gate_d_theta(self.theta, N=self.q_N, control=self.q1, target=self.q2)
+    def derivative(self) -> Derivative:
+        """dK/dtheta * K^dag, as the term acts after the gate (see fSim.parameterised_derivative)."""
+        return [(fixed_fsim_gate_d_theta(self.theta).full() @ self.kernel_fn(self.theta).conj().T, self._wires)]
 
     def flip_pauli(self) -> None:
         pass
@@ -389,16 +389,10 @@ class Measurements():
             return {"Expr": expr, "Ent": [q, std], "Magic": [magic_bar, magic_std], "GKP": [gkp_bar, gkp_std]}
 
 
-    def get_gradient_vector(self, theta: list[Angle]) -> list[Gradient]:
+    def get_gradient_vector(self, theta: list[Angle]) -> list[float]:
+        """Get d_i <psi|H|psi> for each parameter, using the adjoint method."""
         self.QC.state = self.QC.run(angles=theta)
-        psi = self.QC.state
-        self.gradient_list = self.QC.get_gradients()
-        gradients: list[Gradient] = []
-        for i in self.gradient_list:
-            deriv: Gradient = i
-            H_di_psi: qt.Qobj = self.QC.H * deriv
-            d_i_f_theta: Gradient = 2 * np.real(psi.overlap(H_di_psi))
-            gradients.append(d_i_f_theta)
+        gradients: list[float] = self.QC.get_gradients_adjoint()
         return gradients
 
     def train(self, epsilon: float=1e-6, rate: float=0.001, method: str="gradient", 
@@ -440,12 +434,12 @@ class Measurements():
             prev_energy: float = self.minimize_function(angles)
             while diff > epsilon and count < quit_iterations:
                 theta: list[Angle] = self.QC.get_params()
-                gradients: list[Gradient] = self.get_gradient_vector(theta)
+                gradients: list[float] = self.get_gradient_vector(theta)
 
                 if method == "gradient":
                     theta_update: list[Angle] = list(np.array(theta) - rate * np.array(gradients))
                 elif method == "QNG": #some serious problems here, think we need renormalization
-                    QFI = self.get_QFI(grad_list=self.gradient_list)
+                    QFI = self.get_QFI()
                     inverse = np.linalg.pinv(QFI)
                     f_inv_grad_psi = inverse.dot(np.array(gradients))
                     theta_update = list(np.array(theta) - rate * f_inv_grad_psi)
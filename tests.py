@@ -9,6 +9,11 @@ test_gates = True
 test_expr = True
 test_QFI = True
 test_qg = True
+test_adjoint = True
+test_jax = True
+test_batch = True
+test_dtype = True
+test_numba = True
 test_haar = True
 test_bell = True
 test_TFIM = True
@@ -34,6 +39,35 @@ if test_gates:
     out = test_2H.run("random")
     assert out == qt.basis(2, 0) #assert throws exception if conditional not true
     print("Action of 2 Hadamards on |0> is |0> again")
+
+    """Gate kernels acting on their wires should match the full qutip operators."""
+    test_wires = pyqc.PQC(3)
+    layer = [pyqc.R_x(2, 3), pyqc.H(1, 3), pyqc.CNOT([2, 0], 3), pyqc.R_yy([0, 2], 3)]
+    test_wires.add_layer(layer)
+    out = test_wires.run([0.3, 1.1])
+    expected = test_wires.initial_state
+    for g in test_wires.gates:
+        expected = g.operation * expected
+    assert isclose((out - expected).norm(), 0, abs_tol=1e-12)
+    print("Kernels acting on wires agree with full qutip operators")
+
+    """Diagonal gates are applied elementwise - check them the same way."""
+    test_diag = pyqc.PQC(3)
+    layer = [pyqc.H(0, 3), pyqc.H(2, 3), pyqc.R_z(2, 3), pyqc.CZ([2, 0], 3), pyqc.T(1, 3), pyqc.R_zz([2, 1], 3), pyqc.R_x(0, 3)]
+    test_diag.add_layer(layer)
+    out = test_diag.run([0.7, 1.3, 0.4])
+    expected = test_diag.initial_state
+    for g in test_diag.gates:
+        expected = g.operation * expected
+    assert isclose((out - expected).norm(), 0, abs_tol=1e-12)
+    print("Diagonal gates agree with full qutip operators")
+
+    """A product initial state should be the tensor product of the single qubit state."""
+    test_plus = pyqc.PQC(3)
+    plus_state = (qt.basis(2, 0) + qt.basis(2, 1)).unit()
+    test_plus.set_initial_state(plus_state)
+    assert isclose((test_plus.initial_state - qt.tensor([plus_state] * 3)).norm(), 0, abs_tol=1e-12)
+    print("set_initial_state(|+>) gives |+>|+>|+>")
     print("Test passed ✔ \n")
 
 """Tests based on Expr baselines from Fig 1 arXiv:1905.10876v1"""
@@ -146,6 +180,111 @@ if test_qg:
     print("Test passed ✔ \n")
 
 
+"""Adjoint gradients should agree with gradients from the derivative circuit states."""
+if test_adjoint:
+    print("Testing adjoint gradient code:")
+    for circuit_type in ["qg_circuit", "TFIM", "XXZ", "fsim"]:
+        circuit = pyqc.templates.generate_circuit(circuit_type, 4, 2)
+        circuit.state = circuit.run("random")
+        adjoint = circuit.get_gradients_adjoint()
+        from_states = [2 * np.real(circuit.state.overlap(circuit.H * d)) for d in circuit.get_gradients()]
+        assert np.allclose(adjoint, from_states, atol=1e-10)
+        print(f"Adjoint gradients of {circuit_type} circuit agree with derivative circuit gradients")
+    eps = 1e-6
+    for circuit_type in ["qg_circuit", "XXZ", "fermionic", "fsim", "zfsim", "fixed_fsim"]:
+        circuit = pyqc.templates.generate_circuit(circuit_type, 4, 2)
+        angles = np.random.default_rng(3).uniform(0, 2 * np.pi, len(circuit.get_params()))
+        finite_diff = []
+        for i in range(len(angles)):
+            shift = np.zeros(len(angles))
+            shift[i] = eps
+            finite_diff.append((circuit.cost(list(angles + shift)) - circuit.cost(list(angles - shift))) / (2 * eps))
+        circuit.cost(list(angles))
+        assert np.allclose(circuit.get_gradients_adjoint(), finite_diff, atol=1e-6)
+        assert np.allclose(circuit.get_gradients_pshift(), finite_diff, atol=1e-6)
+        print(f"Parameter shift and adjoint gradients of {circuit_type} circuit agree with finite differences")
+    print("Test passed ✔ \n")
+
+"""The jax compiled circuit should give the same state, energy and gradients (jax is optional)."""
+if test_jax:
+    try:
+        import jax
+    except ImportError:
+        print("jax not installed, skipping jax tests \n")
+        test_jax = False
+if test_jax:
+    print("Testing jax compiled circuits:")
+    jax.config.update("jax_enable_x64", True)
+    for circuit_type in ["qg_circuit", "TFIM", "fermionic"]:
+        circuit = pyqc.templates.generate_circuit(circuit_type, 4, 2)
+        if circuit_type == "TFIM": #non-diagonal H
+            circuit.set_H(pyqc.gates.genFockOp(qt.sigmax(), 0, 4) + circuit.H)
+        angles = np.random.default_rng(2).uniform(0, 2 * np.pi, len(circuit.get_params()))
+        run, value_and_grad = circuit.build_jax()
+        energy, gradients = value_and_grad(angles)
+        assert np.allclose(np.asarray(run(angles)), circuit.run(list(angles)).full().ravel(), atol=1e-10)
+        assert isclose(float(energy), circuit.cost(list(angles)), abs_tol=1e-10)
+        assert np.allclose(np.asarray(gradients), circuit.get_gradients_adjoint(), atol=1e-10)
+        print(f"jax {circuit_type} circuit agrees with numpy state, energy and adjoint gradients")
+    print("Test passed ✔ \n")
+
+"""Running a batch of parameter sets at once should match running them one by one."""
+if test_batch:
+    print("Testing batched circuit evaluation:")
+    for circuit_type in ["qg_circuit", "XXZ", "fermionic", "fsim"]:
+        circuit = pyqc.templates.generate_circuit(circuit_type, 4, 2)
+        batch = np.random.default_rng(3).uniform(0, 2 * np.pi, (5, len(circuit.get_params())))
+        states = circuit.run_batch(batch)
+        energies = circuit.cost_batch(batch)
+        for angles, state, energy in zip(batch, states, energies):
+            assert np.allclose(state, circuit.run(list(angles)).full().ravel(), atol=1e-12)
+            assert isclose(energy, circuit.cost(list(angles)), abs_tol=1e-12)
+        print(f"Batch of {circuit_type} circuits agrees with running them one at a time")
+    print("Test passed ✔ \n")
+
+"""complex64 circuits should stay complex64 and agree with complex128 to single precision."""
+if test_dtype:
+    print("Testing complex64 circuits:")
+    for circuit_type in ["qg_circuit", "XXZ", "fermionic"]:
+        circuit = pyqc.templates.generate_circuit(circuit_type, 4, 2)
+        single = pyqc.PQC(4, dtype=np.complex64)
+        single.initial_state = circuit.initial_state
+        if circuit_type == "qg_circuit": #non-diagonal H
+            circuit.set_H(pyqc.gates.genFockOp(qt.sigmax(), 0, 4) + circuit.H)
+        single.set_H(circuit.H)
+        for layer in circuit.layers:
+            single.add_layer(layer)
+        batch = np.random.default_rng(4).uniform(0, 2 * np.pi, (3, len(circuit.get_params())))
+        assert single.run_batch(batch).dtype == np.complex64
+        assert single.cost_batch(batch).dtype == np.float32
+        assert np.allclose(single.cost_batch(batch), circuit.cost_batch(batch), atol=1e-6)
+        assert isclose(single.cost(list(batch[0])), circuit.cost(list(batch[0])), abs_tol=1e-6)
+        assert single._forward().dtype == np.complex64
+        assert np.allclose(single.get_gradients_adjoint(), circuit.get_gradients_adjoint(), atol=1e-5)
+        print(f"complex64 {circuit_type} circuit agrees with complex128 energy and gradients")
+    print("Test passed ✔ \n")
+
+"""The numpy fallback for 1 and 2 qubit gates should agree with the numba kernels."""
+if test_numba and not pyqc.gates.NUMBA_AVAILABLE:
+    print("numba not installed, skipping numba tests \n")
+    test_numba = False
+if test_numba:
+    print("Testing numba kernels against the numpy fallback:")
+    for circuit_type in ["qg_circuit", "TFIM", "XXZ", "fermionic", "fsim"]:
+        circuit = pyqc.templates.generate_circuit(circuit_type, 4, 2)
+        angles = list(np.random.default_rng(5).uniform(0, 2 * np.pi, len(circuit.get_params())))
+        state = circuit.run(angles)
+        gradients = circuit.get_gradients_adjoint()
+        pyqc.gates.NUMBA_AVAILABLE = False
+        try:
+            assert isclose((circuit.run(angles) - state).norm(), 0, abs_tol=1e-12)
+            assert np.allclose(circuit.get_gradients_adjoint(), gradients, atol=1e-12)
+        finally:
+            pyqc.gates.NUMBA_AVAILABLE = True
+        print(f"numpy fallback for {circuit_type} circuit agrees with numba state and adjoint gradients")
+    print("Test passed ✔ \n")
+
+
 class Haar(pyqc.PQC):
     def __init__(self, N):
         self.n_qubits = N